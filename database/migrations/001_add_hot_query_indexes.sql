@@ -0,0 +1,19 @@
+-- Indexes matching the exact shapes of the hot queries.
+-- Run against an existing database; CONCURRENTLY avoids blocking writes
+-- (it cannot run inside a transaction block).
+
+-- Conversation history:
+--   SELECT ... FROM chat_messages WHERE session_id = $1 ORDER BY created_at ASC LIMIT 20
+-- The old single-column index on session_id still forced a sort; the
+-- composite lets PostgreSQL read the LIMIT rows straight off the index.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_messages_session_created
+    ON chat_messages(session_id, created_at);
+
+-- User appointments:
+--   SELECT ... FROM appointments WHERE user_id = $1 ORDER BY appointment_date DESC LIMIT 50
+-- Already covered by idx_appointments_user_date (user_id, appointment_date)
+-- from schema.sql; PostgreSQL scans it backwards for the DESC order, so no
+-- new index is needed.
+
+-- Verify with: EXPLAIN (ANALYZE, BUFFERS) <query>
+-- The plan should show an Index Scan with no Sort node.
@@ -74,6 +74,7 @@ CREATE INDEX idx_chat_sessions_expires ON chat_sessions(expires_at);
 
 CREATE INDEX idx_chat_messages_session_id ON chat_messages(session_id);
 CREATE INDEX idx_chat_messages_created ON chat_messages(created_at);
+CREATE INDEX idx_chat_messages_session_created ON chat_messages(session_id, created_at);
 
 -- Sample data insertions
 INSERT INTO users (email, password_hash, first_name, last_name, phone, role) VALUES
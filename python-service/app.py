@@ -1,12 +1,16 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import os
+import queue
+import threading
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import logging
 from datetime import datetime, timedelta
-import json
+import orjson
+from db import db_conn, query
 from chatbot_service import AppointmentChatbot
 
 # Load environment variables
@@ -19,23 +23,110 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-# Database configuration
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'localhost'),
-    'port': os.getenv('DB_PORT', '5432'),
-    'database': os.getenv('DB_NAME', 'appointment_chatbot'),
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD')
-}
-
-def get_db_connection():
-    """Get database connection"""
+# Optional Redis cache for conversation history. Within a live session the
+# same history prefix is re-read on every turn; serving it from Redis skips
+# a database round-trip per /chat call. Disabled unless REDIS_URL is set.
+HISTORY_CACHE_TTL = int(os.getenv('HISTORY_CACHE_TTL', '3600'))
+
+redis_client = None
+if os.getenv('REDIS_URL'):
+    try:
+        import redis
+        redis_client = redis.Redis.from_url(os.getenv('REDIS_URL'), decode_responses=True)
+    except Exception as e:
+        logger.warning(f"Redis history cache disabled: {e}")
+
+def _history_key(session_id):
+    # v2: rows are stored as [message_type, content] pairs
+    return f"hist:v2:{session_id}"
+
+def history_cache_get(session_id):
+    """Get cached history for a session, or None on miss/error"""
+    if redis_client is None:
+        return None
+    try:
+        rows = redis_client.lrange(_history_key(session_id), 0, -1)
+    except Exception as e:
+        logger.warning(f"Redis read failed, falling back to database: {e}")
+        return None
+    if not rows:
+        return None
+    return [orjson.loads(row) for row in rows]
+
+def history_cache_seed(session_id, messages):
+    """Populate the cache for a session from a database read"""
+    if redis_client is None or not messages:
+        return
+    try:
+        key = _history_key(session_id)
+        pipe = redis_client.pipeline()
+        pipe.delete(key)
+        pipe.rpush(key, *[orjson.dumps(msg).decode() for msg in messages])
+        pipe.expire(key, HISTORY_CACHE_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Redis seed failed: {e}")
+
+def history_cache_append(session_id, message_type, content):
+    """Append one message to an already-seeded session cache"""
+    if redis_client is None:
+        return
     try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except psycopg2.Error as e:
-        logger.error(f"Database connection error: {e}")
-        raise
+        key = _history_key(session_id)
+        pipe = redis_client.pipeline()
+        # rpushx so a never-seeded session doesn't get a partial history
+        pipe.rpushx(key, orjson.dumps([message_type, content]).decode())
+        pipe.ltrim(key, -20, -1)
+        pipe.expire(key, HISTORY_CACHE_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Redis append failed: {e}")
+
+# Persistence for streamed turns happens off the request thread so the
+# stream can close as soon as the last token is sent
+persist_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='persist')
+
+# Background message writer. The user doesn't need the bot-message INSERT
+# to complete before seeing the reply, so plain turns enqueue their row
+# here and a daemon thread flushes batches (up to WRITE_BATCH_MAX rows,
+# waiting at most WRITE_BATCH_WAIT for more) through flush_messages.
+# Shutdown is signalled with a sentinel on the queue so the writer itself
+# flushes its in-flight batch plus anything still queued before exiting.
+WRITE_BATCH_MAX = 200
+WRITE_BATCH_WAIT = 0.05
+
+write_queue = queue.Queue()
+_WRITE_STOP = object()
+
+def _write_loop():
+    while True:
+        rows = [write_queue.get()]
+        try:
+            while len(rows) < WRITE_BATCH_MAX and rows[-1] is not _WRITE_STOP:
+                rows.append(write_queue.get(timeout=WRITE_BATCH_WAIT))
+        except queue.Empty:
+            pass
+        if rows[-1] is _WRITE_STOP:
+            rows.pop()
+            while True:
+                try:
+                    rows.append(write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            flush_messages(rows)
+            return
+        flush_messages(rows)
+
+_writer_thread = threading.Thread(target=_write_loop, daemon=True,
+                                  name='message-writer')
+_writer_thread.start()
+
+def _stop_writer():
+    """Ask the writer to flush its final batch and wait for it"""
+    write_queue.put(_WRITE_STOP)
+    _writer_thread.join(timeout=5)
+
+atexit.register(_stop_writer)
 
 # Initialize chatbot service
 chatbot = AppointmentChatbot()
@@ -69,23 +160,20 @@ def chat():
         logger.info(f"Processing chat message for session {session_id}")
         
         # Get conversation history
-        conversation_history = get_conversation_history(session_id)
+        conversation_history = load_turn_history(session_id, message)
         
         # Process message with chatbot
         response = chatbot.process_message(
             message=message,
             user_id=user_id,
             user_info=user_info,
-            conversation_history=conversation_history
+            conversation_history=conversation_history,
+            session_id=session_id
         )
         
-        # Store bot response in database
-        store_message(session_id, 'bot', response['message'], response.get('metadata', {}))
-        
-        # If appointment was created, update session with appointment_id
-        if response.get('appointment_created'):
-            update_session_appointment(session_id, response.get('appointment_id'))
-        
+        # Store bot response (and appointment link, if any) in database
+        persist_turn(session_id, response)
+
         return jsonify({
             'message': response['message'],
             'metadata': response.get('metadata', {}),
@@ -96,25 +184,104 @@ def chat():
         logger.error(f"Error processing chat message: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
-def get_conversation_history(session_id):
-    """Get conversation history for a session"""
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streaming chat endpoint (server-sent events)
+
+    Emits each LLM chunk as it is generated, so the first token reaches
+    the client while the rest of the reply is still being produced. The
+    final event carries the metadata; persistence runs in the background
+    so the stream closes as soon as the last token is sent.
+    """
+    data = request.get_json()
+
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+
+    message = data.get('message')
+    session_id = data.get('sessionId')
+    user_id = data.get('userId')
+    user_info = data.get('userInfo', {})
+
+    if not all([message, session_id, user_id]):
+        return jsonify({'error': 'Missing required fields'}), 400
+
+    logger.info(f"Streaming chat message for session {session_id}")
+
+    conversation_history = load_turn_history(session_id, message)
+
+    def generate():
+        response = None
+        try:
+            for kind, payload in chatbot.stream_message(
+                message=message,
+                user_id=user_id,
+                user_info=user_info,
+                conversation_history=conversation_history,
+                session_id=session_id
+            ):
+                if kind == 'chunk':
+                    yield 'data: ' + orjson.dumps({'delta': payload}).decode() + '\n\n'
+                else:
+                    response = payload
+
+            if response is not None:
+                persist_executor.submit(persist_turn, session_id, response)
+                yield 'data: ' + orjson.dumps({
+                    'done': True,
+                    'metadata': response.get('metadata', {}),
+                    'session_id': session_id
+                }).decode() + '\n\n'
+
+        except Exception as e:
+            logger.error(f"Error streaming chat message: {e}")
+            yield 'data: ' + orjson.dumps({'error': 'Internal server error'}).decode() + '\n\n'
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+def load_turn_history(session_id, message):
+    """History for a chat turn, skipping the fetch when it isn't needed
+
+    The common turn shape is a warm session with no appointment. There
+    the chatbot replays its in-memory wrapped history and discards
+    whatever is passed in, so the Redis/DB fetch is pure overhead - only
+    the cache bookkeeping for the new user message runs. Cold sessions
+    take the full fetch path.
+    """
+    if chatbot.has_session(session_id):
+        history_cache_append(session_id, 'user', message)
+        return []
+    return get_conversation_history(session_id, current_message=message)
+
+def get_conversation_history(session_id, current_message=None):
+    """Get conversation history as (message_type, content) pairs
+
+    Those are the only columns the chatbot reads, and plain tuples skip
+    the per-row dict allocation of RealDictCursor. Served from the Redis
+    cache when warm; falls back to the database and seeds the cache on a
+    miss. Either way the returned rows include current_message: the
+    backend stores the user message before calling /chat so the SELECT
+    picks it up, and on a cache hit it is appended to both the cache and
+    the returned list (the Redis read predates the append). Callers that
+    seed from these rows can therefore rely on the current turn being
+    present.
+    """
+    cached = history_cache_get(session_id)
+    if cached is not None:
+        if current_message is not None:
+            history_cache_append(session_id, 'user', current_message)
+            cached.append(('user', current_message))
+        return cached
+
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute("""
-            SELECT message_type, content, created_at
-            FROM chat_messages
-            WHERE session_id = %s
-            ORDER BY created_at ASC
-            LIMIT 20
-        """, (session_id,))
-        
-        messages = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        return [dict(msg) for msg in messages]
+        with db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query('get_hist'), (session_id,))
+
+                messages = cursor.fetchall()
+
+        history_cache_seed(session_id, messages)
+        return messages
         
     except Exception as e:
         logger.error(f"Error getting conversation history: {e}")
@@ -123,39 +290,67 @@ def get_conversation_history(session_id):
 def store_message(session_id, message_type, content, metadata=None):
     """Store a message in the database"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO chat_messages (session_id, message_type, content, metadata)
-            VALUES (%s, %s, %s, %s)
-        """, (session_id, message_type, content, json.dumps(metadata) if metadata else None))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
+        with db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query('ins_msg'),
+                               (session_id, message_type, content,
+                                orjson.dumps(metadata).decode() if metadata else None))
+
+            conn.commit()
+
     except Exception as e:
         logger.error(f"Error storing message: {e}")
 
-def update_session_appointment(session_id, appointment_id):
-    """Update session with appointment_id"""
+def flush_messages(rows):
+    """Store many messages in one round-trip
+
+    Each row is (session_id, message_type, content, metadata), with
+    metadata already serialized. A single multi-row VALUES statement is
+    much faster than one INSERT per message.
+    """
+    if not rows:
+        return
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE chat_sessions
-            SET appointment_id = %s
-            WHERE id = %s
-        """, (appointment_id, session_id))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
+        with db_conn() as conn:
+            with conn.cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO chat_messages (session_id, message_type, content, metadata)
+                    VALUES %s
+                """, rows, page_size=500)
+
+            conn.commit()
+
     except Exception as e:
-        logger.error(f"Error updating session appointment: {e}")
+        logger.error(f"Error flushing messages: {e}")
+
+def persist_turn(session_id, response):
+    """Persist a chat turn's writes off the critical path where possible
+
+    Plain turns enqueue their bot-message row for the background batch
+    writer and return immediately. Turns that create an appointment stay
+    synchronous: the INSERT and the session link run as one writable-CTE
+    statement, a single round-trip.
+    """
+    metadata = response.get('metadata', {})
+    serialized = orjson.dumps(metadata).decode() if metadata else None
+    try:
+        if metadata.get('appointment_created'):
+            with db_conn() as conn:
+                with conn.cursor() as cursor:
+                    # Single statement: INSERT the bot message and link the
+                    # appointment to the session in one round-trip
+                    cursor.execute(query('ins_msg_link'),
+                                   (session_id, 'bot', response['message'], serialized,
+                                    metadata.get('appointment_id'), session_id))
+
+                conn.commit()
+        else:
+            write_queue.put((session_id, 'bot', response['message'], serialized))
+
+        history_cache_append(session_id, 'bot', response['message'])
+
+    except Exception as e:
+        logger.error(f"Error persisting chat turn: {e}")
 
 @app.route('/appointments', methods=['POST'])
 def create_appointment():
@@ -172,36 +367,34 @@ def create_appointment():
             if field not in data:
                 return jsonify({'error': f'Missing required field: {field}'}), 400
         
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute("""
-            INSERT INTO appointments 
-            (user_id, title, description, appointment_date, duration_minutes, 
-             appointment_type, location, notes, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending')
-            RETURNING id, title, description, appointment_date, duration_minutes, 
-                      appointment_type, location, notes, status, created_at
-        """, (
-            data['user_id'],
-            data['title'],
-            data.get('description'),
-            data['appointment_date'],
-            data.get('duration_minutes', 60),
-            data.get('appointment_type', 'general'),
-            data.get('location'),
-            data.get('notes')
-        ))
-        
-        appointment = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
+        with db_conn() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("""
+                    INSERT INTO appointments
+                    (user_id, title, description, appointment_date, duration_minutes,
+                     appointment_type, location, notes, status)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending')
+                    RETURNING id, title, description, appointment_date, duration_minutes,
+                              appointment_type, location, notes, status, created_at
+                """, (
+                    data['user_id'],
+                    data['title'],
+                    data.get('description'),
+                    data['appointment_date'],
+                    data.get('duration_minutes', 60),
+                    data.get('appointment_type', 'general'),
+                    data.get('location'),
+                    data.get('notes')
+                ))
+
+                appointment = cursor.fetchone()
+
+            conn.commit()
+
         return jsonify({
             'appointment_id': appointment['id'],
             'message': 'Appointment created successfully',
-            'appointment': dict(appointment)
+            'appointment': appointment
         })
         
     except Exception as e:
@@ -212,24 +405,14 @@ def create_appointment():
 def get_user_appointments(user_id):
     """Get appointments for a user"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute("""
-            SELECT id, title, description, appointment_date, duration_minutes, 
-                   status, appointment_type, location, notes, created_at, updated_at
-            FROM appointments
-            WHERE user_id = %s
-            ORDER BY appointment_date DESC
-            LIMIT 50
-        """, (user_id,))
-        
-        appointments = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
+        with db_conn() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(query('get_appts'), (user_id,))
+
+                appointments = cursor.fetchall()
+
         return jsonify({
-            'appointments': [dict(apt) for apt in appointments]
+            'appointments': appointments
         })
         
     except Exception as e:
@@ -241,4 +424,8 @@ if __name__ == '__main__':
     debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
     
     logger.info(f"Starting Python chatbot service on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=debug)
+    # /chat is almost entirely I/O-bound (OpenAI call + DB round-trips),
+    # so threads keep many requests in flight per worker. In production,
+    # run under gunicorn instead: gunicorn -w 1 --threads 16 -b 0.0.0.0:8000 app:app
+    # (single worker: per-session history lives in process memory)
+    app.run(host='0.0.0.0', port=port, debug=debug, threaded=True)
@@ -1,16 +1,121 @@
 import os
 import json
+import re
 import logging
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Dict, List, Any, Optional
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db import db_conn, query
 
 logger = logging.getLogger(__name__)
 
+# Keyword tables and regexes built once at import time. The extractors
+# tokenize a message once and test set membership instead of running a
+# separate substring scan per keyword on every call.
+
+# Simple keyword detection for appointment scheduling. Inflected forms are
+# spelled out because matching is by whole token: the old substring scan
+# caught 'meetings', 'visiting', 'reschedule' etc. for free.
+APPOINTMENT_KEYWORDS = frozenset({
+    'schedule', 'schedules', 'scheduled', 'scheduling',
+    'reschedule', 'reschedules', 'rescheduled', 'rescheduling',
+    'book', 'books', 'booked', 'booking',
+    'appointment', 'appointments', 'meeting', 'meetings',
+    'consultation', 'consultations', 'checkup', 'checkups',
+    'visit', 'visits', 'visiting', 'session', 'sessions',
+    'reservation', 'reservations'
+})
+
+# Phrases that indicate the bot response confirms scheduling
+CONFIRMATION_PHRASES = (
+    'scheduled', 'booked', 'confirmed', 'appointment created',
+    'i\'ve scheduled', 'your appointment is', 'appointment has been',
+    'i\'ll schedule', 'let me schedule', 'i can schedule'
+)
+
+# Specific details the user may provide (single tokens and phrases)
+DETAIL_KEYWORDS = frozenset({
+    'tomorrow', 'today', 'monday', 'tuesday', 'wednesday', 'thursday',
+    'friday', 'saturday', 'sunday', 'am', 'pm', 'morning', 'afternoon',
+    'evening', 'medical', 'consultation', 'consultations', 'checkup',
+    'checkups'
+})
+DETAIL_PHRASES = ('next week',)
+
+# Appointment-type cues
+MEDICAL_KEYWORDS = frozenset({
+    'medical', 'doctor', 'doctors', 'checkup', 'checkups', 'health'
+})
+CONSULTATION_KEYWORDS = frozenset({
+    'consultation', 'consultations', 'consult', 'consults', 'consulting'
+})
+FOLLOWUP_KEYWORDS = frozenset({'follow', 'follows', 'following'})
+
+DAYS_OF_WEEK = {
+    'monday': 0, 'tuesday': 1, 'wednesday': 2, 'thursday': 3,
+    'friday': 4, 'saturday': 5, 'sunday': 6
+}
+DAY_RE = re.compile('|'.join(DAYS_OF_WEEK))
+
+TIME_PATTERNS = [
+    re.compile(r'(\d{1,2}):(\d{2})\s*(am|pm)?'),  # 2:30 PM, 14:30
+    re.compile(r'(\d{1,2})\s*(am|pm)'),           # 2 PM, 2pm
+    re.compile(r'(\d{1,2})\s*o\'?clock'),         # 2 o'clock
+]
+
+# The user-message keyword categories folded into one tagged alternation so
+# a message is scanned once and yields the set of category tags that fired,
+# instead of one pass over the text per category. A keyword can carry
+# several tags (e.g. 'checkup' is an appointment cue, a detail cue and a
+# medical cue). The bot-confirmation phrases deliberately get their own
+# pattern: mixing them in would let a phrase match absorb the words inside
+# it (in "appointment has been ..." the 'appointment' tag would never fire).
+_KEYWORD_TAGS = {}
+for _tag, _keywords in (
+    ('appointment', APPOINTMENT_KEYWORDS),
+    ('detail', DETAIL_KEYWORDS | set(DETAIL_PHRASES)),
+    ('medical', MEDICAL_KEYWORDS),
+    ('consultation', CONSULTATION_KEYWORDS),
+    ('follow-up', FOLLOWUP_KEYWORDS),
+):
+    for _kw in _keywords:
+        _KEYWORD_TAGS.setdefault(_kw, set()).add(_tag)
+
+# Longest alternatives first so phrases win over their embedded words; the
+# lookarounds keep token semantics (e.g. 'pm' still matches inside '2pm')
+KEYWORD_RE = re.compile(
+    r"(?<![a-z'])(?:" +
+    '|'.join(re.escape(kw) for kw in sorted(_KEYWORD_TAGS, key=len, reverse=True)) +
+    r")(?![a-z'])"
+)
+
+# Plain substring alternation, like the original per-phrase 'in' checks
+CONFIRM_RE = re.compile(
+    '|'.join(re.escape(p) for p in sorted(CONFIRMATION_PHRASES, key=len, reverse=True))
+)
+
+def scan_keyword_tags(text: str) -> set:
+    """Scan lowered text once and return the set of category tags hit"""
+    hits = set()
+    for match in KEYWORD_RE.finditer(text):
+        hits.update(_KEYWORD_TAGS[match.group(0)])
+    return hits
+
+# In-memory history of already-wrapped LangChain messages, per session
+SESSION_HISTORY_LEN = 20
+MAX_TRACKED_SESSIONS = 1000
+
+@lru_cache(maxsize=1024)
+def _user_context(first_name: str, last_name: str, email: str) -> str:
+    """Per-user context string, cached by user identity"""
+    return f"User Information:\n- Name: {first_name} {last_name}\n- Email: {email}"
+
 class AppointmentChatbot:
     def __init__(self):
         """Initialize the appointment chatbot with LangChain"""
@@ -51,57 +156,102 @@ Always be polite, professional, and helpful. If you're unsure about something, a
         # Create conversation chain
         self.conversation_chain = self.prompt_template | self.llm
 
-    def process_message(self, message: str, user_id: int, user_info: Dict, conversation_history: List[Dict]) -> Dict[str, Any]:
+        # Already-wrapped message objects per session, so each turn only
+        # wraps the new user/bot messages instead of re-allocating
+        # HumanMessage/AIMessage objects for the whole history. Ordered
+        # for LRU eviction once MAX_TRACKED_SESSIONS is exceeded.
+        # Process-local: warm turns trust this over any fetched history,
+        # so the service must run as a single worker process (scale with
+        # threads - see the gunicorn invocation in the README).
+        self._session_history = OrderedDict()
+        self._session_history_lock = threading.Lock()
+
+    @staticmethod
+    def _wrap_history(conversation_history: List) -> List:
+        """Convert (message_type, content) history pairs to LangChain messages"""
+        chat_history = []
+        for message_type, content in conversation_history:
+            if message_type == 'user':
+                chat_history.append(HumanMessage(content=content))
+            elif message_type == 'bot':
+                chat_history.append(AIMessage(content=content))
+        return chat_history
+
+    def _chat_history(self, session_id, conversation_history: List, message: str) -> List:
+        """Get the wrapped history for a turn, reusing per-session objects
+
+        On a session's first turn the rows are wrapped once and kept in a
+        bounded deque; later turns reuse those objects and only the new
+        user message is wrapped (and remembered for the next turn). With
+        no session_id the history is wrapped per call as before.
+        """
+        if session_id is None:
+            return self._wrap_history(conversation_history)
+
+        with self._session_history_lock:
+            history = self._session_history.get(session_id)
+            if history is not None:
+                self._session_history.move_to_end(session_id)
+                chat_history = list(history)
+                # Remember the new user message for the next turn (on a
+                # cold start the loaded rows already include it)
+                history.append(HumanMessage(content=message))
+                return chat_history
+
+            history = deque(self._wrap_history(conversation_history),
+                            maxlen=SESSION_HISTORY_LEN)
+            self._session_history[session_id] = history
+            while len(self._session_history) > MAX_TRACKED_SESSIONS:
+                self._session_history.popitem(last=False)
+            return list(history)
+
+    def has_session(self, session_id) -> bool:
+        """Whether this session's wrapped history is warm in memory"""
+        with self._session_history_lock:
+            return session_id in self._session_history
+
+    def _record_bot_reply(self, session_id, response_text: str):
+        """Append the bot reply to the session's wrapped history"""
+        if session_id is None:
+            return
+        with self._session_history_lock:
+            history = self._session_history.get(session_id)
+            if history is not None:
+                history.append(AIMessage(content=response_text))
+
+    def process_message(self, message: str, user_id: int, user_info: Dict, conversation_history: List, session_id=None) -> Dict[str, Any]:
         """Process user message and generate response"""
         try:
             # Convert conversation history to LangChain messages
-            chat_history = []
-            for msg in conversation_history:
-                if msg['message_type'] == 'user':
-                    chat_history.append(HumanMessage(content=msg['content']))
-                elif msg['message_type'] == 'bot':
-                    chat_history.append(AIMessage(content=msg['content']))
-            
-            # Create system message with current context
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            system_message = self.system_prompt.format(current_datetime=current_time)
-            
-            # Add user info context
+            chat_history = self._chat_history(session_id, conversation_history, message)
+
+
+            # Timestamp computed once per turn and reused below
+            timestamp = datetime.now().isoformat()
+
+            # Add user info context as an extra system message (the
+            # template's system prompt is fixed); the string itself is
+            # cached per user identity
             if user_info:
-                user_context = f"\nUser Information:\n- Name: {user_info.get('firstName', '')} {user_info.get('lastName', '')}\n- Email: {user_info.get('email', '')}"
-                system_message += user_context
-            
+                chat_history.insert(0, SystemMessage(content=_user_context(
+                    user_info.get('firstName', ''),
+                    user_info.get('lastName', ''),
+                    user_info.get('email', '')
+                )))
+
             # Process the message
             response = self.conversation_chain.invoke({
                 "input": message,
                 "chat_history": chat_history
             })
-            
+
             # Extract content from response
             response_text = response.content if hasattr(response, 'content') else str(response)
-            
-            # Analyze response for appointment creation
-            appointment_data = self._extract_appointment_data(message, response_text, user_id)
-            
-            metadata = {
-                'user_id': user_id,
-                'timestamp': datetime.now().isoformat(),
-                'message_length': len(message),
-                'response_length': len(response_text)
-            }
-            
-            if appointment_data:
-                metadata['appointment_data'] = appointment_data
-                metadata['appointment_created'] = True
-                metadata['appointment_id'] = appointment_data.get('id')
-            else:
-                metadata['appointment_created'] = False
-            
-            return {
-                'message': response_text,
-                'metadata': metadata
-            }
-            
+
+            self._record_bot_reply(session_id, response_text)
+
+            return self._finalize_response(message, user_id, response_text, timestamp)
+
         except Exception as e:
             logger.error(f"Error processing message: {e}")
             import traceback
@@ -115,35 +265,93 @@ Always be polite, professional, and helpful. If you're unsure about something, a
                 }
             }
 
+    def stream_message(self, message: str, user_id: int, user_info: Dict, conversation_history: List, session_id=None):
+        """Stream the response as it is generated
+
+        Yields ('chunk', text) for each piece of the LLM reply as it
+        arrives, then ('done', response) where response has the same shape
+        as process_message's return value. Streaming means the first token
+        reaches the client in hundreds of milliseconds instead of waiting
+        for the full reply to be generated.
+        """
+        try:
+            chat_history = self._chat_history(session_id, conversation_history, message)
+
+            timestamp = datetime.now().isoformat()
+
+            if user_info:
+                chat_history.insert(0, SystemMessage(content=_user_context(
+                    user_info.get('firstName', ''),
+                    user_info.get('lastName', ''),
+                    user_info.get('email', '')
+                )))
+
+            # Stream the reply, accumulating the full text for the
+            # appointment analysis once generation finishes
+            parts = []
+            for chunk in self.conversation_chain.stream({
+                "input": message,
+                "chat_history": chat_history
+            }):
+                text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+                if text:
+                    parts.append(text)
+                    yield ('chunk', text)
+
+            response_text = ''.join(parts)
+
+            self._record_bot_reply(session_id, response_text)
+
+            yield ('done', self._finalize_response(message, user_id, response_text, timestamp))
+
+        except Exception as e:
+            logger.error(f"Error streaming message: {e}")
+            yield ('done', {
+                'message': f"I apologize, but I'm experiencing some technical difficulties. Error: {str(e)}",
+                'metadata': {
+                    'error': 'processing_error',
+                    'timestamp': datetime.now().isoformat(),
+                    'error_details': str(e)
+                }
+            })
+
+    def _finalize_response(self, message: str, user_id: int, response_text: str, timestamp: str) -> Dict[str, Any]:
+        """Build the response payload and create an appointment if ready"""
+        # Analyze response for appointment creation
+        appointment_data = self._extract_appointment_data(message, response_text, user_id)
+
+        metadata = {
+            'user_id': user_id,
+            'timestamp': timestamp,
+            'message_length': len(message),
+            'response_length': len(response_text)
+        }
+
+        if appointment_data:
+            metadata['appointment_data'] = appointment_data
+            metadata['appointment_created'] = True
+            metadata['appointment_id'] = appointment_data.get('id')
+        else:
+            metadata['appointment_created'] = False
+
+        return {
+            'message': response_text,
+            'metadata': metadata
+        }
+
     def _extract_appointment_data(self, user_message: str, bot_response: str, user_id: int) -> Optional[Dict]:
         """Extract appointment data from conversation and create appointment if ready"""
         try:
-            # Simple keyword detection for appointment scheduling
-            appointment_keywords = [
-                'schedule', 'book', 'appointment', 'meeting', 'consultation',
-                'checkup', 'visit', 'session', 'reservation', 'make an appointment'
-            ]
-            
+            hits = scan_keyword_tags(user_message.lower())
+
             # Check if user wants to schedule something
-            if not any(keyword in user_message.lower() for keyword in appointment_keywords):
+            if 'appointment' not in hits:
                 return None
-            
-            # Check if bot response indicates appointment should be created
-            confirmation_keywords = [
-                'scheduled', 'booked', 'confirmed', 'appointment created',
-                'i\'ve scheduled', 'your appointment is', 'appointment has been',
-                'i\'ll schedule', 'let me schedule', 'i can schedule'
-            ]
-            
-            # Also check if user provided specific details
-            detail_keywords = [
-                'tomorrow', 'today', 'next week', 'monday', 'tuesday', 'wednesday', 
-                'thursday', 'friday', 'saturday', 'sunday', 'am', 'pm', 'morning',
-                'afternoon', 'evening', 'medical', 'consultation', 'checkup'
-            ]
-            
-            has_details = any(keyword in user_message.lower() for keyword in detail_keywords)
-            bot_confirms = any(keyword in bot_response.lower() for keyword in confirmation_keywords)
+
+            # Check if the user provided specific details or the bot
+            # response indicates an appointment should be created
+            has_details = 'detail' in hits
+            bot_confirms = CONFIRM_RE.search(bot_response.lower()) is not None
             
             # Create appointment if user provided details or bot confirms scheduling
             if has_details or bot_confirms:
@@ -166,6 +374,9 @@ Always be polite, professional, and helpful. If you're unsure about something, a
         """Parse appointment details from user message and bot response"""
         try:
             # This is a simplified parser - in a real implementation, you'd use more sophisticated NLP
+            message_lower = user_message.lower()
+            hits = scan_keyword_tags(message_lower)
+
             appointment_data = {
                 'title': 'Appointment',
                 'description': user_message,
@@ -174,31 +385,31 @@ Always be polite, professional, and helpful. If you're unsure about something, a
                 'location': None,
                 'notes': None
             }
-            
+
             # Extract appointment type
-            if any(word in user_message.lower() for word in ['medical', 'doctor', 'checkup', 'health']):
+            if 'medical' in hits:
                 appointment_data['appointment_type'] = 'medical'
                 appointment_data['title'] = 'Medical Appointment'
-            elif any(word in user_message.lower() for word in ['consultation', 'consult']):
+            elif 'consultation' in hits:
                 appointment_data['appointment_type'] = 'consultation'
                 appointment_data['title'] = 'Consultation'
-            elif any(word in user_message.lower() for word in ['follow', 'follow-up']):
+            elif 'follow-up' in hits:
                 appointment_data['appointment_type'] = 'follow-up'
                 appointment_data['title'] = 'Follow-up Appointment'
-            
+
             # Parse date and time with better logic
             appointment_data['appointment_date'] = self._parse_date_time(user_message)
-            
+
             # Extract duration
-            if '30 minutes' in user_message.lower() or 'half hour' in user_message.lower():
+            if '30 minutes' in message_lower or 'half hour' in message_lower:
                 appointment_data['duration_minutes'] = 30
-            elif '45 minutes' in user_message.lower():
+            elif '45 minutes' in message_lower:
                 appointment_data['duration_minutes'] = 45
-            elif '90 minutes' in user_message.lower() or '1.5 hours' in user_message.lower():
+            elif '90 minutes' in message_lower or '1.5 hours' in message_lower:
                 appointment_data['duration_minutes'] = 90
-            elif '2 hours' in user_message.lower() or '120 minutes' in user_message.lower():
+            elif '2 hours' in message_lower or '120 minutes' in message_lower:
                 appointment_data['duration_minutes'] = 120
-            
+
             return appointment_data
             
         except Exception as e:
@@ -207,48 +418,27 @@ Always be polite, professional, and helpful. If you're unsure about something, a
 
     def _parse_date_time(self, user_message: str) -> str:
         """Parse date and time from user message"""
-        import re
-        from datetime import datetime, timedelta
-        
         message_lower = user_message.lower()
-        
+        now = datetime.now()
+
         # Default to tomorrow at 10 AM if no specific time mentioned
-        base_date = datetime.now() + timedelta(days=1)
-        base_date = base_date.replace(hour=10, minute=0, second=0, microsecond=0)
-        
-        # Parse "today" 
+        base_date = (now + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+
+        # Parse "today"
         if 'today' in message_lower:
-            base_date = datetime.now().replace(hour=10, minute=0, second=0, microsecond=0)
-        
-        # Parse "tomorrow"
-        elif 'tomorrow' in message_lower:
-            base_date = datetime.now() + timedelta(days=1)
-            base_date = base_date.replace(hour=10, minute=0, second=0, microsecond=0)
-        
-        # Parse specific days of the week
-        days_of_week = {
-            'monday': 0, 'tuesday': 1, 'wednesday': 2, 'thursday': 3,
-            'friday': 4, 'saturday': 5, 'sunday': 6
-        }
-        
-        for day_name, day_num in days_of_week.items():
-            if day_name in message_lower:
-                days_ahead = day_num - datetime.now().weekday()
-                if days_ahead <= 0:  # Target day already happened this week
-                    days_ahead += 7
-                base_date = datetime.now() + timedelta(days=days_ahead)
-                base_date = base_date.replace(hour=10, minute=0, second=0, microsecond=0)
-                break
+            base_date = now.replace(hour=10, minute=0, second=0, microsecond=0)
+
+        # Parse specific days of the week: one scan for all seven names,
+        # and the "already happened this week" wraparound folds into the
+        # modulo (1..7 days ahead, never 0)
+        day_match = DAY_RE.search(message_lower)
+        if day_match:
+            days_ahead = (DAYS_OF_WEEK[day_match.group(0)] - now.weekday() - 1) % 7 + 1
+            base_date = (now + timedelta(days=days_ahead)).replace(hour=10, minute=0, second=0, microsecond=0)
         
         # Parse time patterns
-        time_patterns = [
-            r'(\d{1,2}):(\d{2})\s*(am|pm)?',  # 2:30 PM, 14:30
-            r'(\d{1,2})\s*(am|pm)',           # 2 PM, 2pm
-            r'(\d{1,2})\s*o\'?clock',         # 2 o'clock
-        ]
-        
-        for pattern in time_patterns:
-            match = re.search(pattern, message_lower)
+        for pattern in TIME_PATTERNS:
+            match = pattern.search(message_lower)
             if match:
                 if ':' in match.group(0):  # Format like 2:30 PM
                     hour = int(match.group(1))
@@ -282,38 +472,23 @@ Always be polite, professional, and helpful. If you're unsure about something, a
     def _create_appointment(self, user_id: int, appointment_data: Dict) -> Optional[int]:
         """Create appointment in database"""
         try:
-            conn = psycopg2.connect(
-                host=os.getenv('DB_HOST', 'localhost'),
-                port=os.getenv('DB_PORT', '5432'),
-                database=os.getenv('DB_NAME', 'appointment_chatbot'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD')
-            )
-            
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO appointments 
-                (user_id, title, description, appointment_date, duration_minutes, 
-                 appointment_type, location, notes, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending')
-                RETURNING id
-            """, (
-                user_id,
-                appointment_data['title'],
-                appointment_data['description'],
-                appointment_data['appointment_date'],
-                appointment_data['duration_minutes'],
-                appointment_data['appointment_type'],
-                appointment_data.get('location'),
-                appointment_data.get('notes')
-            ))
-            
-            appointment_id = cursor.fetchone()[0]
-            conn.commit()
-            cursor.close()
-            conn.close()
-            
+            with db_conn() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query('ins_appt'), (
+                        user_id,
+                        appointment_data['title'],
+                        appointment_data['description'],
+                        appointment_data['appointment_date'],
+                        appointment_data['duration_minutes'],
+                        appointment_data['appointment_type'],
+                        appointment_data.get('location'),
+                        appointment_data.get('notes')
+                    ))
+
+                    appointment_id = cursor.fetchone()[0]
+
+                conn.commit()
+
             logger.info(f"Created appointment {appointment_id} for user {user_id}")
             return appointment_id
             
@@ -324,30 +499,13 @@ Always be polite, professional, and helpful. If you're unsure about something, a
     def get_user_appointments(self, user_id: int) -> List[Dict]:
         """Get appointments for a user"""
         try:
-            conn = psycopg2.connect(
-                host=os.getenv('DB_HOST', 'localhost'),
-                port=os.getenv('DB_PORT', '5432'),
-                database=os.getenv('DB_NAME', 'appointment_chatbot'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD')
-            )
-            
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            
-            cursor.execute("""
-                SELECT id, title, description, appointment_date, duration_minutes, 
-                       status, appointment_type, location, notes, created_at, updated_at
-                FROM appointments
-                WHERE user_id = %s
-                ORDER BY appointment_date DESC
-                LIMIT 50
-            """, (user_id,))
-            
-            appointments = cursor.fetchall()
-            cursor.close()
-            conn.close()
-            
-            return [dict(apt) for apt in appointments]
+            with db_conn() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    cursor.execute(query('get_appts'), (user_id,))
+
+                    appointments = cursor.fetchall()
+
+            return appointments
             
         except Exception as e:
             logger.error(f"Error getting appointments: {e}")
@@ -0,0 +1,140 @@
+import os
+import atexit
+import logging
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import psycopg2.extensions
+import psycopg2.pool
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Database configuration
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'localhost'),
+    'port': os.getenv('DB_PORT', '5432'),
+    'database': os.getenv('DB_NAME', 'appointment_chatbot'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASSWORD')
+}
+
+# Server-side prepared statements skip PostgreSQL's parse/plan step per
+# call, but PREPARE is session-scoped: behind a transaction-pooling proxy
+# (pgbouncer in transaction mode, see database/pgbouncer.ini) a different
+# server session may handle each transaction, so set
+# DB_PREPARE_STATEMENTS=False there and queries run as plain SQL instead.
+PREPARE_STATEMENTS = os.getenv('DB_PREPARE_STATEMENTS', 'True').lower() == 'true'
+
+class _PreparedConnection(psycopg2.extensions.connection):
+    """Connection that remembers whether the hot statements are PREPAREd
+
+    The marker has to live on a Python subclass: psycopg2's C connection
+    type has no instance __dict__, so setting an attribute on it raises.
+    """
+    statements_prepared = False
+
+# Connection pool shared by the whole service - opening a fresh connection
+# per request costs a TCP + TLS + auth handshake on every chat turn.
+# putconn closes any connection returned while minconn are already idle,
+# so minconn is the steady-state pool size rather than a floor: it
+# defaults to DB_POOL_MAX so connections actually get reused under
+# concurrency instead of being churned (and re-PREPAREd) per request.
+_POOL_MAX = int(os.getenv('DB_POOL_MAX', '20'))
+_POOL_MIN = int(os.getenv('DB_POOL_MIN', str(_POOL_MAX)))
+
+POOL = psycopg2.pool.ThreadedConnectionPool(
+    _POOL_MIN,
+    _POOL_MAX,
+    connection_factory=_PreparedConnection,
+    **DB_CONFIG
+)
+
+atexit.register(POOL.closeall)
+
+# The hot queries, by name. Callers run them via query(name); when
+# prepared statements are enabled each pooled connection PREPAREs these
+# once and the call sites execute the prepared form.
+STATEMENTS = {
+    # Newest 20 messages, re-sorted into chronological order - the same
+    # window the Redis list (LTRIM -20 -1) and the in-memory deque keep
+    'get_hist': """
+        SELECT message_type, content
+        FROM (
+            SELECT message_type, content, created_at
+            FROM chat_messages
+            WHERE session_id = %s
+            ORDER BY created_at DESC
+            LIMIT 20
+        ) recent
+        ORDER BY created_at ASC
+    """,
+    'ins_msg': """
+        INSERT INTO chat_messages (session_id, message_type, content, metadata)
+        VALUES (%s, %s, %s, %s)
+    """,
+    # Bot-message INSERT and appointment link merged into one statement via
+    # a writable CTE, for the turns that create an appointment
+    'ins_msg_link': """
+        WITH m AS (
+            INSERT INTO chat_messages (session_id, message_type, content, metadata)
+            VALUES (%s, %s, %s, %s)
+        )
+        UPDATE chat_sessions
+        SET appointment_id = %s
+        WHERE id = %s
+    """,
+    'ins_appt': """
+        INSERT INTO appointments
+        (user_id, title, description, appointment_date, duration_minutes,
+         appointment_type, location, notes, status)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending')
+        RETURNING id
+    """,
+    'get_appts': """
+        SELECT id, title, description, appointment_date, duration_minutes,
+               status, appointment_type, location, notes, created_at, updated_at
+        FROM appointments
+        WHERE user_id = %s
+        ORDER BY appointment_date DESC
+        LIMIT 50
+    """
+}
+
+def _prepare_sql(name, sql):
+    """Rewrite a %s-parameterized statement as a PREPARE command"""
+    for i in range(sql.count('%s')):
+        sql = sql.replace('%s', f'${i + 1}', 1)
+    return f"PREPARE {name} AS {sql}"
+
+if PREPARE_STATEMENTS:
+    _QUERY_SQL = {
+        name: f"EXECUTE {name}({', '.join(['%s'] * sql.count('%s'))})"
+        for name, sql in STATEMENTS.items()
+    }
+else:
+    _QUERY_SQL = STATEMENTS
+
+def query(name):
+    """SQL text to execute for a named hot query"""
+    return _QUERY_SQL[name]
+
+def _prepare_statements(conn):
+    """Prepare the hot statements once per pooled connection"""
+    with conn.cursor() as cursor:
+        for name, sql in STATEMENTS.items():
+            cursor.execute(_prepare_sql(name, sql))
+    conn.commit()
+    conn.statements_prepared = True
+
+@contextmanager
+def db_conn():
+    """Borrow a connection from the pool and return it when done"""
+    conn = POOL.getconn()
+    try:
+        if PREPARE_STATEMENTS and not conn.statements_prepared:
+            _prepare_statements(conn)
+        yield conn
+    finally:
+        POOL.putconn(conn)